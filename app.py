@@ -31,8 +31,15 @@ Use it at your own risk, and check results carefully before submitting.
 import datetime as dt
 # Argument parsing
 import argparse
-# Data management
+# Caching and parallel loading of f/x rates
+import functools
+from concurrent.futures import ThreadPoolExecutor
+# Local f/x rate cache
+import sqlite3
+from contextlib import closing
+# Data management (pandas with pyarrow installed)
 import pandas as pd
+import numpy as np
 # FlexQuery IB
 from ibflex import client
 # Currency conversion
@@ -68,6 +75,9 @@ currency = 'USD'
 # Country ID to be used for counterparty if asset is German
 counterpartCountryCodeGermanStocks = 'IE' # The counterparty for German stocks is Interactive Brokers, Ireland
 
+# Local cache of loaded f/x rates, so re-runs don't load them from yahoo finance again (historical rates don't change):
+fxCacheFile = 'fx_cache.sqlite'
+
 # FlexQuery settings 
 """
 # Kontoumsatz-Flex-Query - Einstellungen:
@@ -130,32 +140,79 @@ else:
 
 # ## Functions
 
+@functools.lru_cache(maxsize=4096)
 def fxRate (currency, date): 
-    # Returns f/x rate on given date from yahoo finance
+    # Returns f/x rate on given date (datetime.date) from yahoo finance, cached per currency and date
+    # (NaN if there is no rate on that day, None if it could not be loaded)
     if currency == 'EUR':
         return 1
     
-    date = pd.to_datetime(date, format='ISO8601')
     try:
         minDate = date + dt.timedelta(days=0)
         maxDate = date + dt.timedelta(days=1)
-        fx = yf.download(currency + "EUR=X", start=minDate, end=maxDate, auto_adjust=True, progress=False).sort_values(by=['Date'])['Close'].values[0]
+        # Ticker.history instead of yf.download, as the latter is not thread-safe:
+        history = yf.Ticker(currency + "EUR=X").history(start=minDate, end=maxDate, auto_adjust=True)
     except:
-        fx = 0
-    return fx
+        return None
+    if len(history.index) == 0:
+        return np.nan
+    return history.sort_index()['Close'].values[0]
+
+def fxRates (currencies, startDate, endDate):
+    # Returns f/x rates of all given currencies within the period from yahoo finance with a single download
+    # (one row per currency and trading day; currencies that could not be loaded are missing)
+    rates = pd.DataFrame(columns=['Datum', 'Währung', 'fxRate']).astype({'Datum': 'datetime64[ns]', 'fxRate': 'float64'})
+    tickers = [c + "EUR=X" for c in currencies if c != 'EUR']
+    if len(tickers) == 0:
+        return rates
+    
+    try:
+        fx = yf.download(tickers, start=startDate, end=endDate, auto_adjust=True, progress=False)['Close']
+        fx = fx.rename_axis('Datum').reset_index().melt(id_vars='Datum', var_name='Währung', value_name='fxRate')
+        fx['Währung'] = fx['Währung'].str.replace('EUR=X', '')
+        rates = fx.dropna(subset=['fxRate'])
+    except Exception as Ex:
+        print('Could not download f/x rates for ' + ', '.join(currencies) + ' in one request, loading them per day. ' + str(Ex))
+    return rates
+
+def loadFxCache (fileName):
+    # Returns all f/x rates stored in the local cache file (empty, if there is no cache yet or it can't be read)
+    rates = pd.DataFrame(columns=['Datum', 'Währung', 'fxRate']).astype({'Datum': 'datetime64[ns]', 'fxRate': 'float64'})
+    try:
+        with closing(sqlite3.connect(fileName)) as con:
+            if con.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='fxRates'").fetchone() is None:
+                return rates # No cache yet
+            rates = pd.read_sql('SELECT Datum, Währung, fxRate FROM fxRates', con, parse_dates=['Datum'])
+    except (sqlite3.Error, pd.errors.DatabaseError) as Ex:
+        print('Could not read f/x rates from cache file ' + fileName + ', loading them from yahoo finance. ' + str(Ex))
+    return rates
+
+def saveFxCache (fileName, rates):
+    # Stores the given f/x rates in the local cache file (replaces the previous content)
+    # The cache is only an optimisation, so a failed write is reported but doesn't stop the run.
+    try:
+        with closing(sqlite3.connect(fileName)) as con:
+            rates.to_sql('fxRates', con, if_exists='replace', index=False)
+    except Exception as Ex:
+        print('Could not write f/x rates to cache file ' + fileName + ': ' + str(Ex))
 
 
 # ## Main script
 
 # Load data from Interactive Brokers FlexQuery:
 
-# Initialize empty dataframe:
-df = pd.DataFrame()
+# Columns needed from the FlexQuery (all others are dropped right after reading):
+neededCols = ['currency', 'assetCategory', 'description', 'isin', 'ibOrderID', 'tradeDate', 'buySell', 'origTradePrice', 'quantity', 'proceeds', 'putCall', 'listingExchange', 'transactionType']
+# Text columns of these (pyarrow types columns without any value as null, which can't be filled with strings later):
+stringCols = ['currency', 'assetCategory', 'description', 'isin', 'tradeDate', 'buySell', 'putCall', 'listingExchange', 'transactionType']
+
+# Initialize empty list of dataframes (one per account):
+dfs = []
 
-for i in range(len(accounts)):
-    token = accounts[i]['token']
-    queryID = accounts[i]['queryID']
-    nameAccount = accounts[i]['accountName']
+for account in accounts:
+    token = account['token']
+    queryID = account['queryID']
+    nameAccount = account['accountName']
     
     # Read from API
     try:
@@ -163,12 +220,13 @@ for i in range(len(accounts)):
 
         # Read into dataframe:
         try:
-            # Transfer xml to dataframe:
-            df_new = pd.read_xml(response, xpath=".//Trade")
+            # Transfer xml to dataframe (only needed columns, pyarrow-backed dtypes):
+            df_new = pd.read_xml(response, xpath=".//Trade", parser='lxml', dtype_backend='pyarrow')[neededCols]
+            df_new = df_new.astype({col: 'string[pyarrow]' for col in stringCols})
             df_new['Account'] = nameAccount 
 
-            # Join new data with existing data:
-            df = pd.concat([df, df_new])
+            # Collect new data, joined after all accounts are loaded:
+            dfs.append(df_new)
         except:
             print('No transactions found in FlexQuery ' + str(token) + ', or format wrong. Error in transaction transfer from IB', 'Could not read query.')
             exit()
@@ -176,14 +234,13 @@ for i in range(len(accounts)):
     except Exception as Ex:
         print('Could not load raw data, or no transactions available, from ' + nameAccount + ' for token: "' + str(token) +'". ' + str(Ex))
 
-# Remove canceled trades:
-df = df.loc[df['transactionType']!='TradeCancel']
-
-# Remove unneeded columns from dataframe
-neededCols = ['currency', 'assetCategory', 'description', 'isin', 'ibOrderID', 'tradeDate', 'buySell', 'origTradePrice', 'quantity', 'proceeds', 'putCall', 'listingExchange']
+# Stop, if no account could be loaded (an empty CSV would look like "nothing to report"):
+if len(dfs)==0:
+    print('No data loaded from Interactive Brokers, no CSV created.')
+    exit()
 
-# Filter dataframe:
-df = df[neededCols]
+# Join data of all accounts:
+df = pd.concat(dfs, ignore_index=True)
 
 # Rename columns to already match the required AWV csv format:
 renameCols = {'currency':'Währung', 'description':'Zahlungszweck / Wertpapierbezeichnung', 'isin':'ISIN', 'tradeDate':'Datum', 'buySell':'Transaktion', 'quantity':'Stückzahl',
@@ -191,7 +248,11 @@ renameCols = {'currency':'Währung', 'description':'Zahlungszweck / Wertpapierbe
 
 df = df.rename(columns=renameCols)
 
-df['Datum'] = pd.to_datetime(df['Datum'], format='ISO8601')
+# Remove canceled trades and irrelevant transactions (=Currencies) before any further processing
+# (trades without transactionType or assetCategory are kept, comparisons on empty values would drop them):
+df = df.loc[df['transactionType'].ne('TradeCancel').fillna(True) & df['assetCategory'].ne('CASH').fillna(True)]
+
+df['Datum'] = pd.to_datetime(df['Datum'], format='%Y-%m-%d', cache=True) # Datumsformat of the FlexQuery: YYYY-MM-DD
 
 # Filter time period to defined month:
 startDate = dt.datetime(year, month, 1)
@@ -201,133 +262,140 @@ else:
     endDate = dt.datetime(year, month + 1, 1)
 
 # Apply date filter to dataframe:
-df = df.loc[df['Datum']>= startDate]
-df = df.loc[df['Datum']< endDate]
-
-# Remove irrelevant transactions (=Currencies):
-df = df.loc[df['assetCategory']!='CASH']
+df = df.loc[(df['Datum']>=startDate) & (df['Datum']<endDate)]
+
+# Add fx rates (from the local cache, otherwise one download for the whole month, daily look-up only for currencies missing in it):
+rates = loadFxCache(fxCacheFile)
+notLoadedPairs = []
+uncached = df.loc[df['Währung']!='EUR', ['Datum', 'Währung']].drop_duplicates().merge(rates, on=['Datum', 'Währung'], how='left', indicator=True)
+uncached = uncached.loc[uncached['_merge']=='left_only', ['Datum', 'Währung']]
+if len(uncached.index)>0:
+    newRates = fxRates(uncached['Währung'].unique(), startDate, endDate)
+    uncached = uncached.merge(newRates, on=['Datum', 'Währung'], how='left')
+    missing = (~uncached['Währung'].isin(newRates['Währung'])).to_numpy()
+    if missing.any():
+        # Load the remaining rates in parallel, once per currency and day:
+        pairs = list(zip(uncached.loc[missing, 'Währung'], uncached.loc[missing, 'Datum'].dt.date))
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            missingRates = list(executor.map(lambda p: fxRate(*p), pairs))
+        notLoadedPairs = [p for p, r in zip(pairs, missingRates) if r is None]
+        notLoaded = uncached.index[missing][[r is None for r in missingRates]]
+        uncached.loc[missing, 'fxRate'] = [np.nan if r is None else r for r in missingRates]
+        # Rates that could not be loaded are not cached, so the next run tries again:
+        uncached = uncached.drop(notLoaded)
+    
+    # Cache all loaded rates; days without rate (e.g. weekend) are cached as empty rate, so they are not looked up again:
+    newEntries = [r for r in [newRates, uncached] if len(r.index)>0]
+    if len(newEntries)>0:
+        rates = pd.concat([r for r in [rates] + newEntries if len(r.index)>0], ignore_index=True).drop_duplicates(subset=['Datum', 'Währung'], keep='last')
+        saveFxCache(fxCacheFile, rates)
+
+# Stop, if rates could not be loaded (the amounts would be missing in the CSV without notice):
+if len(notLoadedPairs)>0:
+    print('Could not load f/x rates from yahoo finance for: ' + ', '.join(c + ' ' + str(d) for c, d in notLoadedPairs) + '. Please try again later, no CSV created.')
+    exit()
 
-# Add fx rates:
-df['fxRate'] = None
-df['Datum'] = pd.to_datetime(df['Datum'], format='ISO8601')
-df['fxRate'] = df.apply(lambda x: fxRate(x['Währung'], x['Datum']), axis=1)
+df = df.merge(rates, on=['Datum', 'Währung'], how='left')
+df.loc[df['Währung']=='EUR', 'fxRate'] = 1
+df['fxRate'] = df['fxRate'].fillna(0) # Only days without rate left here (e.g. weekend), same as the daily look-up
+df['fxRate'] = df['fxRate'].astype('float64') # Keep Betrag calculation on numeric values (not python objects)
 
 # Translate transaction types to german terms; include "ca." transactions:
-df.loc[df['Transaktion']=='BUY', 'Transaktion'] = 'Kauf'
-df.loc[df['Transaktion']=='BUY (Ca.)', 'Transaktion'] = 'Kauf'
-df.loc[df['Transaktion']=='SELL', 'Transaktion'] = 'Verkauf'
-df.loc[df['Transaktion']=='SELL (Ca.)', 'Transaktion'] = 'Verkauf'
+transactionTypes = {'BUY':'Kauf', 'BUY (Ca.)':'Kauf', 'SELL':'Verkauf', 'SELL (Ca.)':'Verkauf'}
+df['Transaktion'] = df['Transaktion'].map(transactionTypes).fillna(df['Transaktion'])
 df['Betrag'] = df['Betrag NC'] * df['fxRate'] / 1000 # in 1000 EUR
 
 # Fill NaN fields with empty string, because otherwise, they don't get included in grouping:
 df['putCall'] = df['putCall'].fillna('') 
 df['ISIN'] = df['ISIN'].fillna('') 
 
-# Group partial executions on orderID into df_g(rouped):
-df_g = df.groupby(['orderID', 'Währung', 'Zahlungszweck / Wertpapierbezeichnung', 'ISIN', 'Transaktion', 'putCall', 'listingExchange']).agg({'Stückzahl': 'sum', 'Datum':'mean', 'Betrag':'sum'}).reset_index()
+# Use categorical dtypes for the grouping columns (few distinct values), so grouping works on integer codes instead of strings:
+categoryCols = ['Währung', 'Zahlungszweck / Wertpapierbezeichnung', 'ISIN', 'Transaktion', 'putCall', 'listingExchange']
+df[categoryCols] = df[categoryCols].astype('category')
+
+# Trades without orderID (e.g. deliveries from option assignments/exercises) are not reported,
+# same as when partial executions were grouped on orderID first:
+df = df.loc[df['orderID'].notna()]
 
-if len(df_g.index)>0:
+# Group partial executions and orders to month in one pass
+# (observed=True: only existing combinations of the categories, sort=False: the CSV doesn't need a specific order):
+df_m = df.groupby(['Währung', 'Zahlungszweck / Wertpapierbezeichnung', 'ISIN', 'putCall', 'listingExchange', 'Transaktion'], observed=True, sort=False).agg({'Stückzahl': 'sum', 'Betrag':'sum'}).reset_index()
+
+if len(df_m.index)>0:
     # Load country from ISIN:
     # This is an approximation, it could be that the ISIN country code is not identical with the location of the country.
-    df_g['Länderschlüssel']=df_g.apply(lambda x: x['ISIN'][0:2], axis=1)
+    df_m['Länderschlüssel']=df_m['ISIN'].str.slice(0, 2)
     
     # Set it to InteractiveBrokers Location for all DE stocks:
-    df_g.loc[df_g['Länderschlüssel']=='DE', 'Länderschlüssel']= counterpartCountryCodeGermanStocks
+    df_m.loc[df_m['Länderschlüssel']=='DE', 'Länderschlüssel']= counterpartCountryCodeGermanStocks
 else:
-    df_g['Länderschlüssel'] = ''
-
-# Group to month:
-df_m = df_g.groupby(['Währung', 'Zahlungszweck / Wertpapierbezeichnung', 'Länderschlüssel', 'ISIN', 'putCall', 'listingExchange', 'Transaktion']).agg({'Stückzahl': 'sum', 'Betrag':'sum'}).reset_index()
+    df_m['Länderschlüssel'] = ''
 
 # Limit to relevant transactions above limit (on a monthly base):
 if withoutLimit < 1:
     df_m = df_m.loc[abs(df_m['Betrag']) >= limit]
 
-try:
-    # Add additional columns:
-    df_m['Belegart']=3 # Put everything as "Eingehende Zahlung"
-    df_m.loc[df_m['Transaktion']=='Kauf', 'Belegart'] = 4 # Change the purchases to "Ausgehende Zahlung"
-    
-    # Assign options first for Kennzahl: 
-    # * 821: Optionen, ausländische Terminbörsen
-    # * 831: Optionen, inländische Terminbörsen
-    # For option trades, use the look-up dictionary "optionExchanges" to get the right Kennzahl:
-    df_m.loc[df_m['putCall']!='', 'Kennzahl'] = df_m.loc[df_m['putCall']!=''].apply(lambda x: optionExchanges[x['listingExchange']], axis=1)
-except Exception as E:
-    if len(df_m.index)>0:
-        print('Error modifying dataframe:'+str(E))
-
-try:
-    # Kennzahl für Aktien:
-    # * 104: Aktien ausländischer Emittenten
-    # * 258: Nicht-Bank-Aktien inländischer Emittenten
-
-    # +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-    # ATTENTION: This will not create the right result for ADR (American Depository Receipts).
-    # They need to be classified by the related stock. E.g. Biontech. 
-    # Requires manual adjustment after upload!!!
-    # +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-    
-    # Set all transactions that don't have a Kennzahl yet to "ausländische Emittenten":
-    df_m.loc[(df_m['ISIN'].str[0:2]!='DE') & (df_m['ISIN'].str[0:2]!=''), 'Kennzahl'] = 104 # ausländische Emittenten
-    
-    # ... and then switch those where the WKN is "DE" to German.
-    df_m.loc[df_m['ISIN'].str[0:2]=='DE', 'Kennzahl'] = 258 # inländische Nichtbanken
-    
-    df_m['Stückzahl'] = df_m['Stückzahl'].abs()
-except Exception as E:
-    if len(df_m.index)>0:
-        print('Error modifying dataframe- changing Stückzahl:'+str(E))
-
-try:
-    # Sort columns in correct order:
-    df_m = df_m [['Belegart', 
-                  'Kennzahl', 
-                  'Zahlungszweck / Wertpapierbezeichnung', 
-                  'Länderschlüssel', 
-                  'Betrag', 
-                  'ISIN', 
-                  'Stückzahl',
-                  'Währung'
-                 ]]
-except Exception as E:
-    if len(df_m.index)>0:
-        print('Error reducing df columns:'+str(E))
+# Add additional columns:
+# Purchases are "Ausgehende Zahlung", everything else "Eingehende Zahlung":
+df_m['Belegart'] = np.where(df_m['Transaktion']=='Kauf', 4, 3)
+
+# Kennzahl für Optionen: 
+# * 821: Optionen, ausländische Terminbörsen
+# * 831: Optionen, inländische Terminbörsen
+# For option trades, use the look-up dictionary "optionExchanges" to get the right Kennzahl.
+
+# Kennzahl für Aktien (all other transactions with ISIN):
+# * 104: Aktien ausländischer Emittenten
+# * 258: Nicht-Bank-Aktien inländischer Emittenten (ISIN starting with "DE")
+
+# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+# ATTENTION: This will not create the right result for ADR (American Depository Receipts).
+# They need to be classified by the related stock. E.g. Biontech. 
+# Requires manual adjustment after upload!!!
+# +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+options = df_m['putCall']!=''
+countryCodes = df_m['ISIN'].str[0:2]
+df_m['Kennzahl'] = np.where(options, df_m['listingExchange'].map(optionExchanges),
+                            np.where(countryCodes=='DE', 258, np.where(countryCodes!='', 104, np.nan)))
+
+# Stop, if a Kennzahl is missing (the CSV would be rejected by the Melderegister):
+unknownExchanges = df_m.loc[options & df_m['Kennzahl'].isna(), 'listingExchange'].unique()
+if len(unknownExchanges)>0:
+    print('Option exchanges missing in optionExchanges, please add them: ' + ', '.join(unknownExchanges))
+    exit()
+if df_m['Kennzahl'].isna().any():
+    print('No Kennzahl found (no option and no ISIN) for: ' + ', '.join(df_m.loc[df_m['Kennzahl'].isna(), 'Zahlungszweck / Wertpapierbezeichnung'].astype(str)))
+    exit()
+
+# Some values need to be inverted so they appear with a positive sign:
+df_m['Stückzahl'] = df_m['Stückzahl'].abs()
+df_m['Betrag'] = df_m['Betrag'].abs()
+
+# Sort columns in correct order:
+df_m = df_m [['Belegart', 
+              'Kennzahl', 
+              'Zahlungszweck / Wertpapierbezeichnung', 
+              'Länderschlüssel', 
+              'Betrag', 
+              'ISIN', 
+              'Stückzahl',
+              'Währung'
+             ]]
 
 # Round and turn to integer:
 df_m = df_m.round()
 
 # Columns that need to be converted to integer:
-intCols = [['Belegart', 
-            'Kennzahl', 
-            'Betrag', 
-            'Stückzahl',
-          ]]
-
-# Run through intCols and convert:
-try:
-    for intCol in intCols:
-        df_m[intCol] = df_m[intCol].astype("int")
-except Exception as E:
-    if len(df_m.index)>0:
-        print('Error modifying dataframe:'+str(E))
-
-# Finally, some values need to be inverted so they appear with a positive sign:
-try:
-    # Turn values positive:
-    df_g['Betrag']=df_g['Betrag'].abs()
-    df_g['Stückzahl'] = df_g['Stückzahl'].abs() 
-    df_m['Betrag']=df_m['Betrag'].abs()
-    df_m['Stückzahl'] = df_m['Stückzahl'].abs()
-except Exception as E:
-    if len(df_m.index)>0:
-        print('Error modifying dataframe:'+str(E))
+intCols = ['Belegart', 
+           'Kennzahl', 
+           'Betrag', 
+           'Stückzahl',
+          ]
+df_m[intCols] = df_m[intCols].astype("int")
 
 # Export to CSV file:
 filename = 'Bundesbank AWV Melderegister ' + str(year) + "-" + str(month).zfill(2) + '.csv'
 df_m.to_csv(filename, index=False, header=False, sep = ';')
 
-# Sort descending (for display in e-mail):
-df_g = df_g.sort_values(by=['Betrag'], ascending=False)
 print('Data translation completed.')
 print('CSV-Datei erstellt: '+filename)